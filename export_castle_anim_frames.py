@@ -43,15 +43,45 @@ bl_info = {
 
 import bpy
 import os
+import sys
 from bpy_extras.io_utils import (
     orientation_helper,
     path_reference_mode,
     axis_conversion,
     )
 from bpy.props import *
-from mathutils import Vector
 import addon_utils
 import html
+import urllib.parse
+import json
+import base64
+import hashlib
+import queue
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+# Buffer size (in bytes) used when writing the castle-anim-frames file.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Size (in characters) of chunks used when copying temporary frame files.
+COPY_CHUNK_SIZE = 1 << 16
+
+# Extensions of texture files saved when gltf_shared_textures,
+# for the MIME types used by glTF exporter.
+# Images with other MIME types are saved without extension,
+# and keep their mimeType in glTF.
+SHARED_TEXTURE_EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/webp': '.webp',
+}
+
+# How many items (mostly frames, with their temporary files) may wait
+# to be written to the castle-anim-frames file.
+# Limits the disk space used by temporary files.
+OUTPUT_QUEUE_SIZE = 4
 
 @orientation_helper(axis_forward='Z', axis_up='Y')
 class ExportCastleAnimFrames(bpy.types.Operator):
@@ -95,6 +125,18 @@ class ExportCastleAnimFrames(bpy.types.Operator):
             default=False,
             )
 
+    dedup_static_frames: BoolProperty(
+            name="Skip Static Frames",
+            description="Do not export frames where the scene doesn't change (compared to the previous and next exported frame). Detects changes to object transformations, visibility, armature poses and shape key values, other animations (like particles or animated materials) may be lost when this is enabled. The end of each static segment is evaluated twice, so this is only faster when the animation has static segments.",
+            default=False,
+            )
+
+    animated_visibility: BoolProperty(
+            name="Animated Visibility",
+            description="Check objects visibility (and selection) at each frame, when calculating bounding box. Use this if the visibility is animated. Otherwise it is checked only once, which is faster.",
+            default=False,
+            )
+
     frame_format: EnumProperty(
         name='Format',
         items=(('GLTF', 'glTF',
@@ -107,6 +149,12 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         default='X3D'
     )
 
+    gltf_shared_textures: BoolProperty(
+            name="Share glTF Textures",
+            description="Save textures of glTF frames once, to files in a subdirectory next to the castle-anim-frames file, instead of embedding them in every frame. Makes castle-anim-frames file much smaller when textures are used, but it is no longer a single self-contained file. Note that each frame is then loaded whole into memory (to process glTF JSON), instead of being copied in small chunks.",
+            default=False,
+            )
+
     # ------------------------------------------------------------------------
     # properies passed through to the X3D/glTF exporter,
     # definition copied from io_scene_x3d/__init__.py
@@ -171,8 +219,11 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         box.prop_search(self, 'actions_object', context.scene, "objects")
 
         box.prop(self, "frame_skip")
+        box.prop(self, "dedup_static_frames")
         box.prop(self, "make_duplicates_real")
+        box.prop(self, "animated_visibility")
         box.prop(self, "frame_format")
+        box.prop(self, "gltf_shared_textures")
 
         box = layout.box()
         box.label(text="X3D settings:")
@@ -187,22 +238,50 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         box.prop(self, "axis_up")
         box.prop(self, "path_mode")
 
-    def is_bound_box_empty(self, bound_box):
+    def is_bound_box_empty(self, bound_box_corners):
         """Is the Blender bound_box empty.
 
-        The box is represented as 24 floats, as defined by Blender API, see
+        The box is represented as 8 corners (24 floats), as defined by Blender API, see
         https://www.blender.org/api/blender_python_api_current/bpy.types.Object.html#bpy.types.Object.bound_box
         (somewhat uncomfortable representation, IMHO...).
+        Here it must be given as NumPy array with shape (8, 3).
         """
 
-        for f in bound_box:
-            if f != -1:
-                return False
-        return True
+        return bool(np.all(bound_box_corners == -1))
+
+    def get_visible_objects(self, context, objects):
+        """Filter objects, leaving only visible ones
+        (and only selected, if use_selection)."""
 
-    def get_current_bounding_box(self, context):
+        view_layer = context.view_layer
+        if self.use_selection:
+            return [obj for obj in objects if obj.visible_get(view_layer=view_layer) and obj.select_get(view_layer=view_layer)]
+        else:
+            return [obj for obj in objects if obj.visible_get(view_layer=view_layer)]
+
+    def update_bounding_box_objects(self, context):
+        """Calculate self.bounding_box_objects, the scene objects that
+        may contribute to the bounding box.
+
+        Unless animated_visibility, this also checks visibility and selection,
+        so it doesn't need to be checked at each frame.
+
+        Call this when the scene objects change (e.g. after duplicates_make_real).
+        """
+
+        if self.animated_visibility:
+            objects = context.scene.objects
+        else:
+            objects = self.get_visible_objects(context, context.scene.objects)
+
+        # filter out cameras, lights etc., otherwise they have a bounding box
+        self.bounding_box_objects = [ob for ob in objects
+            if ob.type not in ('ARMATURE', 'LATTICE', 'EMPTY', 'CAMERA', 'LAMP', 'SPEAKER')]
+
+    def get_current_bounding_box(self, context, depsgraph):
         """Calculate current scene bounding box.
         Returns two 3D vectors, bounding box center and size.
+        Objects are evaluated using the given depsgraph.
 
         If the box is empty, the center is (0, 0, 0) and size is (-1, -1, -1).
         This is consistent with X3D Group node bboxCenter/Size
@@ -211,66 +290,49 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         (see http://michalis.ii.uni.wroc.pl/cge-www-preview/castle_animation_frames.php).
         """
 
-        view_layer = context.view_layer
-        scene_box_empty = True
-        scene_box_min = (0.0, 0.0, 0.0)
-        scene_box_max = (0.0, 0.0, 0.0)
+        scene_box_min = None
+        scene_box_max = None
 
-        if self.use_selection:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer) and obj.select_get(view_layer=view_layer)]
-        else:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer)]
-
-        global_matrix = axis_conversion(to_forward=self.axis_forward, to_up=self.axis_up).to_4x4()
+        # self.bounding_box_objects are already filtered by type,
+        # and (unless animated_visibility) by visibility and selection
+        objects = self.bounding_box_objects
+        if self.animated_visibility:
+            objects = self.get_visible_objects(context, objects)
 
         for ob in objects:
-            # filter out cameras, lights etc., otherwise they have a bounding box
-            if (ob.type not in ('ARMATURE', 'LATTICE', 'EMPTY', 'CAMERA', 'LAMP', 'SPEAKER')) and \
-               (not self.is_bound_box_empty(ob.bound_box)):
-                # world-space bounding box calculation,
-                # see blender/2.78/scripts/addons/object_fracture_cell/fracture_cell_setup.py
-                # and http://blender.stackexchange.com/questions/8459/get-blender-x-y-z-and-bounding-box-with-script
-                object_box_points = [global_matrix @ ob.matrix_world @ Vector(corner) for corner in ob.bound_box]
-
-                # calculate object_box_min/max
-                object_box_min = (object_box_points[0].x, object_box_points[0].y,  object_box_points[0].z)
-                object_box_max = object_box_min
-                for v in object_box_points:
-                    object_box_min = (min(v.x, object_box_min[0]),
-                                      min(v.y, object_box_min[1]),
-                                      min(v.z, object_box_min[2]))
-                    object_box_max = (max(v.x, object_box_max[0]),
-                                      max(v.y, object_box_max[1]),
-                                      max(v.z, object_box_max[2]))
-
-                # update scene_box_min/max/empty
-                if scene_box_empty:
-                    scene_box_min = object_box_min
-                    scene_box_max = object_box_max
-                else:
-                    scene_box_min = (min(scene_box_min[0], object_box_min[0]),
-                                     min(scene_box_min[1], object_box_min[1]),
-                                     min(scene_box_min[2], object_box_min[2]))
-                    scene_box_max = (max(scene_box_max[0], object_box_max[0]),
-                                     max(scene_box_max[1], object_box_max[1]),
-                                     max(scene_box_max[2], object_box_max[2]))
-                scene_box_empty = False
-
-        # calculate scene_box_center/size from scene_box_min/max/empty
-        if scene_box_empty:
+            ob_eval = ob.evaluated_get(depsgraph)
+            corners = np.array(ob_eval.bound_box, dtype=np.float64)
+            if self.is_bound_box_empty(corners):
+                continue
+
+            # world-space bounding box calculation,
+            # see blender/2.78/scripts/addons/object_fracture_cell/fracture_cell_setup.py
+            # and http://blender.stackexchange.com/questions/8459/get-blender-x-y-z-and-bounding-box-with-script
+            # Transform all 8 corners at once.
+            matrix = np.array(self.global_matrix @ ob_eval.matrix_world, dtype=np.float64)
+            object_box_points = corners @ matrix[:3, :3].T + matrix[:3, 3]
+            object_box_min = object_box_points.min(axis=0)
+            object_box_max = object_box_points.max(axis=0)
+
+            # update scene_box_min/max
+            if scene_box_min is None:
+                scene_box_min = object_box_min
+                scene_box_max = object_box_max
+            else:
+                scene_box_min = np.minimum(scene_box_min, object_box_min)
+                scene_box_max = np.maximum(scene_box_max, object_box_max)
+
+        # calculate scene_box_center/size from scene_box_min/max
+        if scene_box_min is None:
             scene_box_center = (0.0, 0.0, 0.0)
             scene_box_size = (-1.0, -1.0, -1.0)
         else:
-            scene_box_center = ((scene_box_min[0] + scene_box_max[0]) / 2.0,
-                                (scene_box_min[1] + scene_box_max[1]) / 2.0,
-                                (scene_box_min[2] + scene_box_max[2]) / 2.0)
-            scene_box_size = (scene_box_max[0] - scene_box_min[0],
-                              scene_box_max[1] - scene_box_min[1],
-                              scene_box_max[2] - scene_box_min[2])
+            scene_box_center = tuple(((scene_box_min + scene_box_max) / 2.0).tolist())
+            scene_box_size = tuple((scene_box_max - scene_box_min).tolist())
 
         return (scene_box_center, scene_box_size)
 
-    def fix_scene_before_x3d_export(self, context):
+    def fix_scene_before_x3d_export(self, context, depsgraph):
         """Fix the Blender scene before exporting.
 
         Blender 2.8 has a weird bug: running bpy.ops.export_scene.x3d
@@ -286,8 +348,11 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         doesn't help to reset them.
         """
 
-        depsgraph = context.evaluated_depsgraph_get()
         for obj in bpy.data.objects:
+            # Object without material slots cannot have materials on the mesh,
+            # so avoid (possibly expensive) to_mesh() call.
+            if not obj.material_slots:
+                continue
             uses_temporary_mesh = False
             # The logic when to set uses_temporary_mesh follows X3D exporter
             if obj.type in {'MESH', 'CURVE', 'SURFACE', 'FONT'}:
@@ -302,14 +367,22 @@ class ExportCastleAnimFrames(bpy.types.Operator):
                         mat.tag = False
                 obj.to_mesh_clear()
 
-    def output_frame_x3d(self, context, output_file):
-        """Append a given frame to output_file in X3D format."""
+    def create_temp_file(self, extension, temp_dir):
+        """Create a new, unique temporary file for a single frame in temp_dir.
+        Returns its name. The caller is responsible for removing it.
 
-        # calculate filenames stuff
-        (output_dir, output_basename) = os.path.split(self.filepath)
-        temp_file_name = os.path.join(output_dir, os.path.splitext(output_basename)[0] + "_tmp.x3d")
+        Each frame uses a different temporary file, as the frame may still
+        wait in self.output_queue when the next frame is exported.
+        """
+
+        with tempfile.NamedTemporaryFile(dir=temp_dir, prefix=self.temp_file_prefix,
+            suffix=extension, delete=False) as temp_file:
+            return temp_file.name
+
+    def output_frame_x3d(self, context, depsgraph, temp_file_name):
+        """Export the current frame to temp_file_name in X3D format."""
 
-        self.fix_scene_before_x3d_export(context)
+        self.fix_scene_before_x3d_export(context, depsgraph)
 
         # write X3D with animation frame
         bpy.ops.export_scene.x3d(filepath=temp_file_name,
@@ -327,26 +400,12 @@ class ExportCastleAnimFrames(bpy.types.Operator):
             axis_up                    = self.axis_up,
             path_mode                  = self.path_mode)
 
-        # read from temporary X3D file, and remove it
-        with open(temp_file_name, 'r') as temp_contents_file:
-            temp_contents = temp_contents_file.read()
-        os.remove(temp_file_name)
-
-        # add X3D content
-        temp_contents = temp_contents.replace('<?xml version="1.0" encoding="UTF-8"?>', '')
-        temp_contents = temp_contents.replace('<!DOCTYPE X3D PUBLIC "ISO//Web3D//DTD X3D 3.0//EN" "http://www.web3d.org/specifications/x3d-3.0.dtd">', '')
-        output_file.write(temp_contents)
-
-    def output_frame_gltf(self, context, output_file):
-        """Append a given frame to output_file in glTF format."""
+    def output_frame_gltf(self, context, temp_file_name):
+        """Export the current frame to temp_file_name in glTF format."""
 
         # Note that using glb would be more efficient,
         # but then textures are embedded too in every frame, which are not useful.
 
-        # calculate filenames stuff
-        (output_dir, output_basename) = os.path.split(self.filepath)
-        temp_file_name = os.path.join(output_dir, os.path.splitext(output_basename)[0] + "_tmp.gltf")
-
         bpy.ops.export_scene.gltf(filepath=temp_file_name,
             export_format = 'GLTF_EMBEDDED',
             check_existing = False,
@@ -371,88 +430,353 @@ class ExportCastleAnimFrames(bpy.types.Operator):
             export_force_sampling = False
             )
 
-        # read from temporary glTF file, and remove it
+    def append_frame_x3d(self, output_file, temp_file_name):
+        """Append X3D content of temp_file_name to output_file."""
+
+        # copy X3D content from temporary file (without the XML prolog).
+        # The prolog lines can only occur at the beginning,
+        # so check only them, and copy the rest in large chunks.
+        with open(temp_file_name, 'r') as temp_contents_file:
+            line = temp_contents_file.readline()
+            while line.startswith(('<?xml ', '<!DOCTYPE ')):
+                line = temp_contents_file.readline()
+            output_file.write(line)
+            shutil.copyfileobj(temp_contents_file, output_file, COPY_CHUNK_SIZE)
+
+    def share_gltf_texture(self, image_data, mime_type):
+        """Save image_data to self.shared_textures_dir, unless the same image
+        was already saved during this export. Returns URL of the saved image,
+        relative to the castle-anim-frames file."""
+
+        image_hash = hashlib.sha1(image_data).hexdigest()
+        if image_hash not in self.shared_textures:
+            image_file_name = '%s%s' % (image_hash,
+                SHARED_TEXTURE_EXTENSIONS.get(mime_type, ''))
+            os.makedirs(self.shared_textures_dir, exist_ok=True)
+            with open(os.path.join(self.shared_textures_dir, image_file_name), 'wb') as image_file:
+                image_file.write(image_data)
+            # URL must be percent-encoded, e.g. output file name may contain spaces
+            self.shared_textures[image_hash] = urllib.parse.quote(
+                os.path.basename(self.shared_textures_dir) + '/' + image_file_name)
+        return self.shared_textures[image_hash]
+
+    def remap_gltf_buffer_views(self, node, new_indexes):
+        """Change all "bufferView" references inside glTF JSON node
+        according to new_indexes dictionary (old index -> new index)."""
+
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'bufferView' and isinstance(value, int):
+                    node[key] = new_indexes[value]
+                elif key != 'extras':
+                    self.remap_gltf_buffer_views(value, new_indexes)
+        elif isinstance(node, list):
+            for value in node:
+                self.remap_gltf_buffer_views(value, new_indexes)
+
+    def remove_gltf_buffer_views(self, gltf, buffers_data, removed_views):
+        """Remove bufferViews with indexes in removed_views from glTF JSON,
+        together with their data in embedded buffers.
+
+        buffers_data contains decoded data of each buffer
+        (or None, if the buffer is not embedded, it is then left unchanged).
+        """
+
+        new_buffers_data = [None if data is None else bytearray() for data in buffers_data]
+        new_indexes = {}
+        new_views = []
+        for index, view in enumerate(gltf['bufferViews']):
+            if index in removed_views:
+                continue
+            new_indexes[index] = len(new_views)
+            new_views.append(view)
+            new_data = new_buffers_data[view['buffer']]
+            if new_data is not None:
+                # keep 4-byte alignment of bufferViews, as glTF exporter does
+                new_data.extend(bytes(-len(new_data) % 4))
+                start = view.get('byteOffset', 0)
+                view['byteOffset'] = len(new_data)
+                new_data.extend(buffers_data[view['buffer']][start:start + view['byteLength']])
+
+        gltf['bufferViews'] = new_views
+        self.remap_gltf_buffer_views(gltf, new_indexes)
+
+        for buffer, new_data in zip(gltf['buffers'], new_buffers_data):
+            if new_data is not None:
+                buffer['byteLength'] = len(new_data)
+                buffer['uri'] = 'data:application/octet-stream;base64,' + \
+                    base64.b64encode(new_data).decode('ascii')
+
+    def share_gltf_textures(self, temp_file_name):
+        """Return glTF content of temp_file_name (as a string),
+        with embedded images moved to files in self.shared_textures_dir.
+
+        Each unique image is saved only once during the whole export,
+        other frames only refer to it.
+        With GLTF_EMBEDDED the images are stored in bufferViews of the (single,
+        embedded as data URI) buffer, these bufferViews are removed from the buffer.
+        Images embedded directly as data URIs are handled too.
+        """
+
         with open(temp_file_name, 'r') as temp_contents_file:
-            temp_contents = temp_contents_file.read()
-        os.remove(temp_file_name)
+            gltf = json.load(temp_contents_file)
 
-        # add glTF content
+        buffers_data = []
+        for buffer in gltf.get('buffers', []):
+            uri = buffer.get('uri', '')
+            if uri.startswith('data:'):
+                buffers_data.append(base64.b64decode(uri.split(',', 1)[1]))
+            else:
+                buffers_data.append(None)
+
+        image_views = set()
+        for image in gltf.get('images', []):
+            if 'bufferView' in image:
+                view = gltf['bufferViews'][image['bufferView']]
+                data = buffers_data[view['buffer']]
+                if data is None:
+                    continue
+                start = view.get('byteOffset', 0)
+                image_data = data[start:start + view['byteLength']]
+                image_views.add(image['bufferView'])
+                mime_type = image.get('mimeType', '')
+                image['uri'] = self.share_gltf_texture(image_data, mime_type)
+                del image['bufferView']
+                # mimeType is optional with uri, but keep it if the file extension
+                # doesn't determine the format
+                if mime_type in SHARED_TEXTURE_EXTENSIONS:
+                    del image['mimeType']
+            elif image.get('uri', '').startswith('data:'):
+                (header, data) = image['uri'].split(',', 1)
+                mime_type = header[len('data:'):].split(';', 1)[0]
+                image['uri'] = self.share_gltf_texture(base64.b64decode(data), mime_type)
+                if mime_type not in SHARED_TEXTURE_EXTENSIONS and mime_type:
+                    image['mimeType'] = mime_type
+
+        if image_views:
+            self.remove_gltf_buffer_views(gltf, buffers_data, image_views)
+
+        return json.dumps(gltf, separators=(',', ':'))
+
+    def append_frame_gltf_shared_textures(self, output_file, temp_file_name):
+        """Append glTF content of temp_file_name to output_file,
+        with textures shared between frames (see share_gltf_textures)."""
+
+        # Note: using quote=False, see append_frame_gltf.
+        output_file.write(html.escape(self.share_gltf_textures(temp_file_name), quote=False))
+
+    def append_frame_gltf(self, output_file, temp_file_name):
+        """Append glTF content of temp_file_name to output_file."""
+
+        # copy glTF content from temporary file.
+        # The file is copied in chunks, to avoid reading (possibly large,
+        # with embedded textures) file into memory at once.
         # Note: using quote=False, because it is not necessary to escape " and ' here,
         # and it would cause a lot of replacements since they are used a lot in JSON.
-        temp_contents = html.escape(temp_contents, quote=False)
-        output_file.write(temp_contents)
+        # Escaping each chunk separately is correct, as html.escape
+        # replaces single characters.
+        with open(temp_file_name, 'r') as temp_contents_file:
+            while True:
+                chunk = temp_contents_file.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output_file.write(html.escape(chunk, quote=False))
+
+    def queue_output(self, text, temp_file_name=None):
+        """Queue writing to the castle-anim-frames file.
 
-    def output_frame(self, context, output_file, frame, frame_start):
-        """Output a given frame to a single file, and add <frame...> line to
-        castle-anim-frames file.
+        The text is written as-is. If temp_file_name is not None,
+        it is a temporary file with a single frame (in self.frame_format),
+        it is appended (after text) and closed with </frame> element,
+        and then removed.
+
+        Blocks if the writing thread lags more than OUTPUT_QUEUE_SIZE items behind.
+        """
+
+        if self.output_error is not None:
+            raise self.output_error
+        self.output_queue.put((text, temp_file_name))
+
+    def write_output_queue(self, output_file, append_frame):
+        """Write items from self.output_queue to output_file,
+        until None is received. Runs in a separate thread.
+
+        append_frame is used to append the temporary file with each frame,
+        it is one of append_frame_xxx methods.
+        As bpy is not thread-safe, this must not access any Blender data,
+        including this operator properties: everything that depends on them
+        must be determined before starting this thread.
+
+        Items are written in the same order they were queued,
+        so the frames are in correct order.
+        If writing (or removing a temporary file) fails, the exception
+        is stored in self.output_error and the remaining items are only
+        removed (without writing). This thread must never die before
+        receiving None, otherwise the exporting thread would block forever
+        on a full queue.
+        """
+
+        while True:
+            item = self.output_queue.get()
+            if item is None:
+                break
+            (text, temp_file_name) = item
+            try:
+                if self.output_error is None:
+                    output_file.write(text)
+                    if temp_file_name is not None:
+                        append_frame(output_file, temp_file_name)
+                        output_file.write('\n\t\t</frame>\n')
+            except BaseException as e:
+                self.output_error = e
+            finally:
+                if temp_file_name is not None:
+                    try:
+                        os.remove(temp_file_name)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        if self.output_error is None:
+                            self.output_error = e
+
+    def output_frame(self, context, frame, frame_start):
+        """Output a given frame to a single file, and queue adding <frame...>
+        element to castle-anim-frames file.
+        The scene must be already set to this frame (by context.scene.frame_set).
 
         Arguments:
-        output_file   -- the handle to write xxx.castle-anim-frames file,
-                         to add <frame...> line.
         frame         -- current frame number.
         frame_start   -- the start frame number, used to shift frame times
                          such that castle-anim-frames animation starts from time = 0.0.
         """
 
-        # set the animation frame (before calculating bounding box
-        # and making duplicates real)
-        context.scene.frame_set(frame)
-
         if self.make_duplicates_real:
             self.make_duplicates_real_before(context)
 
+        # get evaluated depsgraph once, and use it for all calculations in this frame
+        depsgraph = context.evaluated_depsgraph_get()
+
         # calculate bounding box in world space
-        (bounding_box_center, bounding_box_size) = self.get_current_bounding_box(context)
+        (bounding_box_center, bounding_box_size) = self.get_current_bounding_box(context, depsgraph)
 
         if self.frame_format == 'GLTF':
             mime_type = 'model/gltf+json'
         else:
             mime_type = 'model/x3d+xml'
 
-        # write castle-anim-frames line
-        output_file.write('\t\t<frame time="%f" mime_type="%s" bounding_box_center="%f %f %f" bounding_box_size="%f %f %f">\n' %
-          ((frame-frame_start) / 25.0,
-           mime_type,
-           bounding_box_center[0], bounding_box_center[1], bounding_box_center[2],
-           bounding_box_size  [0], bounding_box_size  [1], bounding_box_size  [2]))
+        # castle-anim-frames line
+        time = (frame - frame_start) / self.fps
+        (bc, bs) = (bounding_box_center, bounding_box_size)
+        frame_header = (f'\t\t<frame time="{time:.6f}" mime_type="{mime_type}"'
+          f' bounding_box_center="{bc[0]:.6f} {bc[1]:.6f} {bc[2]:.6f}"'
+          f' bounding_box_size="{bs[0]:.6f} {bs[1]:.6f} {bs[2]:.6f}">\n')
 
+        # Exporting must be done in this (main) thread, as bpy.ops are not thread-safe.
+        # Copying the temporary file into castle-anim-frames is done by
+        # write_output_queue, in parallel with exporting the next frames.
         if self.frame_format == 'GLTF':
-            self.output_frame_gltf(context, output_file)
+            temp_file_name = self.create_temp_file(".gltf", self.gltf_temp_dir)
         else:
-            self.output_frame_x3d(context, output_file)
-
-        output_file.write('\n\t\t</frame>\n')
+            temp_file_name = self.create_temp_file(".x3d", self.output_dir)
+        try:
+            if self.frame_format == 'GLTF':
+                self.output_frame_gltf(context, temp_file_name)
+            else:
+                self.output_frame_x3d(context, depsgraph, temp_file_name)
+            self.queue_output(frame_header, temp_file_name)
+        except BaseException:
+            # once queued, write_output_queue removes the file
+            os.remove(temp_file_name)
+            raise
 
         if self.make_duplicates_real:
             self.make_duplicates_real_after(context)
 
+    def get_scene_fingerprint(self, context):
+        """Calculate a hash of the current scene state, that changes when
+        anything that we detect as animated changes.
+
+        Detects changes to object transformations, visibility,
+        armature poses and shape key values.
+        """
+
+        depsgraph = context.evaluated_depsgraph_get()
+        view_layer = context.view_layer
+        fingerprint = hashlib.blake2b(digest_size=16)
+        for ob in context.scene.objects:
+            ob_eval = ob.evaluated_get(depsgraph)
+            fingerprint.update(bytes([ob.visible_get(view_layer=view_layer)]))
+            fingerprint.update(np.array(ob_eval.matrix_world, dtype=np.float32).tobytes())
+            if ob_eval.pose:
+                for bone in ob_eval.pose.bones:
+                    fingerprint.update(np.array(bone.matrix, dtype=np.float32).tobytes())
+            shape_keys = getattr(ob.data, 'shape_keys', None)
+            if shape_keys:
+                fingerprint.update(np.array([key_block.value for key_block in shape_keys.key_blocks],
+                    dtype=np.float32).tobytes())
+        return fingerprint.digest()
+
     # Export a single animation (e.g. coming from a single action in Blender)
     # to an <animation> element in castle-anim-frames.
     #
     # animation_name must be a string.
     #
     # frame_start, frame_end must be integer.
-    def output_one_animation(self, context, output_file, animation_name, frame_start, frame_end):
+    def output_one_animation(self, context, animation_name, frame_start, frame_end):
         if animation_name != '':
-            output_file.write('\t<animation name="' + animation_name + '">\n')
+            self.queue_output('\t<animation name="' + animation_name + '">\n')
         else:
-            output_file.write('\t<animation>\n')
+            self.queue_output('\t<animation>\n')
 
-        frame = frame_start
-        while frame < frame_end:
-            self.output_frame(context, output_file, frame, frame_start)
-            frame += 1 + self.frame_skip
         # the last frame should be always output, regardless if we would "hit"
         # it with given frame_skip.
-        self.output_frame(context, output_file, frame_end, frame_start)
-
-        output_file.write('\t</animation>\n')
-
-
-    def execute(self, context):
-        output_file = open(self.filepath, 'w')
-        output_file.write('<?xml version="1.0"?>\n')
-        output_file.write('<animations>\n')
+        frames = list(range(frame_start, frame_end, 1 + self.frame_skip)) + [frame_end]
+
+        # When dedup_static_frames, a frame is not exported if the scene in it
+        # is the same as in the previous and the next frame (from frames list).
+        # So the first and last frame of each static segment remain,
+        # and the animation interpolated between them looks the same.
+        # Frame that is the same as the previous one is remembered in
+        # static_frame, and exported only if the next frame turns out different.
+        previous_fingerprint = None
+        static_frame = None
+        skipped_frames = 0
+
+        for frame in frames:
+            # set the animation frame (before calculating bounding box
+            # and making duplicates real)
+            context.scene.frame_set(frame)
+
+            if self.dedup_static_frames:
+                fingerprint = self.get_scene_fingerprint(context)
+                is_static = fingerprint == previous_fingerprint
+                previous_fingerprint = fingerprint
+                if static_frame is not None:
+                    if is_static:
+                        skipped_frames += 1
+                    else:
+                        # static_frame ends the static segment, export it after all
+                        context.scene.frame_set(static_frame)
+                        self.output_frame(context, static_frame, frame_start)
+                        context.scene.frame_set(frame)
+                    static_frame = None
+                if is_static and frame != frames[-1]:
+                    static_frame = frame
+                    continue
+
+            self.output_frame(context, frame, frame_start)
+
+        if skipped_frames != 0:
+            print("Skipped", skipped_frames, "static frames")
+
+        self.queue_output('\t</animation>\n')
+
+
+    def output_animations(self, context):
+        """Export all animations, queueing the castle-anim-frames content."""
+
+        self.queue_output('<?xml version="1.0"?>\n')
+        self.queue_output('<animations>\n')
 
         if self.actions_object != '':
             actions_object_o = context.scene.objects[self.actions_object]
@@ -460,15 +784,19 @@ class ExportCastleAnimFrames(bpy.types.Operator):
             # first get actions_to_export,
             # otherwise when we change the actions_object_o.animation_data.action,
             # an old action may be temporarily considered unused
+            #
+            # Use user_map to determine actions belonging to this object.
+            # It calculates users of all actions in one pass,
+            # much faster than calling actions_object_o.user_of_id(action) for each action.
+            #
+            # It seems detecting usage fails sometimes (see
+            # https://sourceforge.net/p/castle-engine/discussion/general/thread/902a6753/?limit=25#392c),
+            # and reverse ("action.user_of_id(actions_object_o)") doesn't help,
+            # so just always add all actions with "use_fake_user".
+            actions_users = bpy.data.user_map(subset=bpy.data.actions, value_types={'OBJECT'})
             actions_to_export = []
             for action in bpy.data.actions:
-                # Use user_of_id to determine actions belonging to this object.
-                #
-                # It seems it fails to detect usage sometimes (see
-                # https://sourceforge.net/p/castle-engine/discussion/general/thread/902a6753/?limit=25#392c),
-                # and reverse ("action.user_of_id(actions_object_o)") doesn't help,
-                # so just always add all actions with "use_fake_user".
-                if actions_object_o.user_of_id(action) or action.use_fake_user:
+                if action.use_fake_user or actions_object_o in actions_users.get(action, ()):
                     actions_to_export.append(action)
 
             if len(actions_to_export) > 0:
@@ -480,7 +808,7 @@ class ExportCastleAnimFrames(bpy.types.Operator):
                         act_end = int(act_end)
                         actions_object_o.animation_data.action = action
                         print("Exporting action", action.name, "with frames" , act_start, "-", act_end)
-                        self.output_one_animation(context, output_file, action.name, act_start, act_end)
+                        self.output_one_animation(context, action.name, act_start, act_end)
                 finally:
                     # without restoring this, the action selected previously
                     # would be lost, with 0 users
@@ -490,21 +818,57 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         else:
             # if no actions to use, then export whole context.scene.frame_start..end
             print("Exporting animation with frames" , context.scene.frame_start, "-", context.scene.frame_end)
-            self.output_one_animation(context, output_file, "animation", context.scene.frame_start, context.scene.frame_end)
+            self.output_one_animation(context, "animation", context.scene.frame_start, context.scene.frame_end)
+
+        self.queue_output('</animations>\n')
 
-        output_file.write('</animations>\n')
-        output_file.close()
+    def execute(self, context):
+        # calculate things constant for all frames
+        self.fps = context.scene.render.fps / context.scene.render.fps_base
+        self.global_matrix = axis_conversion(to_forward=self.axis_forward, to_up=self.axis_up).to_4x4()
+        self.update_bounding_box_objects(context)
+
+        (self.output_dir, output_basename) = os.path.split(self.filepath)
+        self.temp_file_prefix = os.path.splitext(output_basename)[0] + "_tmp_"
+        # X3D temporary files must be next to the output file,
+        # as X3D exporter calculates relative texture paths from them.
+        # glTF (with embedded textures) can be anywhere, e.g. on a faster disk.
+        self.gltf_temp_dir = os.environ.get('CGE_TMPDIR') or self.output_dir
+        self.shared_textures_dir = os.path.splitext(self.filepath)[0] + "_textures"
+        # maps image content hash -> URL of the shared texture
+        self.shared_textures = {}
+
+        # use a large buffer, as we do many small writes for each frame
+        # (closing the file flushes it)
+        with open(self.filepath, 'w', buffering=OUTPUT_BUFFER_SIZE) as output_file:
+            # Frames are exported in this thread, and written to output_file
+            # by writer_thread, see write_output_queue.
+            self.output_queue = queue.Queue(maxsize=OUTPUT_QUEUE_SIZE)
+            self.output_error = None
+            if self.frame_format != 'GLTF':
+                append_frame = self.append_frame_x3d
+            elif self.gltf_shared_textures:
+                append_frame = self.append_frame_gltf_shared_textures
+            else:
+                append_frame = self.append_frame_gltf
+            writer_thread = threading.Thread(target=self.write_output_queue, args=(output_file, append_frame))
+            writer_thread.start()
+            try:
+                self.output_animations(context)
+            finally:
+                # let writer_thread finish writing all queued items
+                self.output_queue.put(None)
+                writer_thread.join()
+
+        if self.output_error is not None:
+            raise self.output_error
 
         return {'FINISHED'}
 
     # Calculate the default object from which we should take actions.
     # Returns string (object mame, or '' if not found).
     def get_default_actions_object(self, context):
-        view_layer = context.view_layer
-        if self.use_selection:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer) and obj.select_get(view_layer=view_layer)]
-        else:
-            objects = [obj for obj in context.scene.objects if obj.visible_get(view_layer=view_layer)]
+        objects = self.get_visible_objects(context, context.scene.objects)
         more_than_one_armature = False
         armature = None
         for ob in objects:
@@ -531,6 +895,15 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
             self.filepath = blend_filepath + ".castle-anim-frames"
 
+        # in background mode (blender -b) there is no UI to show file dialog,
+        # just export to the given (or default) filepath.
+        # Guess actions_object only if the caller didn't set it,
+        # as there's no dialog to correct it.
+        if bpy.app.background:
+            if not self.properties.is_property_set("actions_object"):
+                self.actions_object = self.get_default_actions_object(context)
+            return self.execute(context)
+
         # initialize actions_object
         self.actions_object = self.get_default_actions_object(context)
 
@@ -538,7 +911,10 @@ class ExportCastleAnimFrames(bpy.types.Operator):
         return {'RUNNING_MODAL'}
 
     def make_duplicates_real_before(self, context):
-        self.old_objects = list(context.scene.objects)
+        # Use set, to quickly check (in make_duplicates_real_after) which objects are new.
+        # Blender objects are hashable (by the underlying data pointer),
+        # unlike id() of their Python wrappers this is stable.
+        self.old_objects = set(context.scene.objects)
         self.old_objects_len = len(self.old_objects)
 
         # Not sure what do I need to override for duplicates_make_real.
@@ -551,6 +927,7 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
         bpy.ops.object.select_all(action='SELECT')
         bpy.ops.object.duplicates_make_real()
+        self.update_bounding_box_objects(context)
 
         # Hm, I cannot seem to be able to undo the duplicates_make_real effect easily.
         # Doing
@@ -587,13 +964,14 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
             selected_count = 0
             for ob in context.scene.objects:
-                ob.select_set((ob in new_objects) and (ob not in self.old_objects))
+                ob.select_set(ob not in self.old_objects)
                 if ob.select_get():
                     selected_count = selected_count + 1
             if selected_count != len(duplicated_objects):
                 raise Exception("Error: we did not select as many as expected, submit a bug")
 
             bpy.ops.object.delete()
+            self.update_bounding_box_objects(context)
 
         final_objects_len = len(list(context.scene.objects))
         if final_objects_len != self.old_objects_len:
@@ -601,6 +979,18 @@ class ExportCastleAnimFrames(bpy.types.Operator):
 
         #print("Done making duplicates real: ", self.old_objects_len, " -> ", new_objects_len, " -> ", final_objects_len)
 
+def export(filepath, **kwargs):
+    """Export the current scene to castle-anim-frames, without any UI.
+
+    Useful for scripts and batch processing (e.g. "blender -b").
+    Other keyword arguments are passed to the operator,
+    see ExportCastleAnimFrames properties.
+    Note that actions_object is not guessed here, by default the whole
+    scene animation (from Start to End) is exported.
+    """
+
+    return bpy.ops.export.castle_anim_frames('EXEC_DEFAULT', filepath=filepath, **kwargs)
+
 def menu_func(self, context):
     self.layout.operator_context = 'INVOKE_DEFAULT'
     self.layout.operator(ExportCastleAnimFrames.bl_idname, text=ExportCastleAnimFrames.bl_label)
@@ -615,4 +1005,10 @@ def unregister():
 
 if __name__ == "__main__":
     register()
-    bpy.ops.export.castle_anim_frames('INVOKE_DEFAULT')
+    # In background mode, export to the file given after "--" on the command-line, like
+    #   blender -b scene.blend --python export_castle_anim_frames.py -- scene.castle-anim-frames
+    script_args = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    if bpy.app.background and script_args:
+        export(script_args[0])
+    else:
+        bpy.ops.export.castle_anim_frames('INVOKE_DEFAULT')